@@ -0,0 +1,5 @@
+# Testy importují moduly z adresáře vakciny stejně, jako když se spouští přímo odtamtud
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "vakciny"))
@@ -0,0 +1,71 @@
+# Pomocný proces pro test obnovy z deníku (test_journal_recovery.py)
+#
+# Provede pevnou syntetickou zátěž přes CommandProcessor s deníkem. Po startu pokračuje za posledním příkazem, který
+# je podle deníku v databázi, po každém příkazu vypíše jeho pořadí (podle toho test volí okamžik SIGKILL) a na konci
+# uloží obsah všech tabulek a GIVESTATISTICS jako JSON.
+#
+# Použití: python journal_worker.py adresar databaseUrl batchSize checkpointEvery|None
+import datetime
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "vakciny"))
+
+import sqlalchemy   # noqa: E402
+
+import Vaccination  # noqa: E402
+import Workload     # noqa: E402
+
+WORKLOAD_START = datetime.datetime(2021, 3, 22, 10, 0)
+WORKLOAD_STEP = datetime.timedelta(seconds=7)
+
+
+def worker_workload():
+    """Příkazy zátěže a čas provedení každého z nich (po ENDDAY začíná další den)"""
+    commands = list(Workload.generate_workload(600, 12, 3, 6, seed=3, queriesPerDay=20,
+                                               today=WORKLOAD_START.date()))
+    times = []
+    now = WORKLOAD_START
+    for line in commands:
+        times.append(now)
+        now = now + WORKLOAD_STEP
+        if line.startswith("ENDDAY"):
+            now = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), WORKLOAD_START.time())
+    return commands, times
+
+
+def worker_state(processor):
+    """Obsah všech tabulek (seřazené řádky) a výstup GIVESTATISTICS"""
+    state = {table.name: sorted([str(value) for value in row]
+                                for row in processor.session.execute(sqlalchemy.select(table)).all())
+             for table in Vaccination.meta.sorted_tables}
+    output = Vaccination.CapturedOutput()
+    Vaccination.givestatistics(processor.stats, output)
+    state["GIVESTATISTICS"] = output.text()
+    return state
+
+
+def worker_run(directory, databaseUrl, batchSize, checkpointEvery):
+    commands, times = worker_workload()
+    journaled = [index for index, line in enumerate(commands)
+                 if line.split(" ")[0] in Vaccination.JOURNAL_OPERATORS]
+
+    processor = Vaccination.CommandProcessor(2, 65, Vaccination.CapturedOutput(), batchSize, databaseUrl=databaseUrl,
+                                             journalFile=os.path.join(directory, "journal"),
+                                             checkpointFile=os.path.join(directory, "checkpoint.db"),
+                                             checkpointEvery=checkpointEvery)
+    sequence = processor.journal_sequence
+    start = journaled[sequence - 1] + 1 if sequence > 0 else 0
+    for index in range(start, len(commands)):
+        processor.execute(Vaccination.parse_command(commands[index]), Vaccination.CapturedOutput(), times[index])
+        print(index, flush=True)
+    processor.commit()
+
+    with open(os.path.join(directory, "state.json"), "w") as file:
+        json.dump(worker_state(processor), file)
+    processor.close()
+
+
+if __name__ == "__main__":
+    worker_run(sys.argv[1], sys.argv[2], int(sys.argv[3]), None if sys.argv[4] == "None" else int(sys.argv[4]))
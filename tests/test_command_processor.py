@@ -0,0 +1,55 @@
+# Testy CommandProcessor: obnova po chybě příkazu
+import copy
+import datetime
+
+import pytest
+
+import Vaccination
+
+NOW = datetime.datetime(2021, 3, 22, 10, 0)     # pondělí, termíny se naplánují na úterý
+
+
+def processor_statistics(stats):
+    """Všechny čítače statistik (GIVESTATISTICS z nich ukazuje jen část)"""
+    return {name: copy.deepcopy(value) for name, value in vars(stats).items() if name not in ("marked", "saved")}
+
+
+@pytest.mark.parametrize("batchSize", [1, 100])
+def test_recover_restores_statistics_without_rebuilding(monkeypatch, batchSize):
+    processor = Vaccination.CommandProcessor(2, 65, Vaccination.CapturedOutput(), batchSize)
+    try:
+        lines = ["CREATECENTER 1 0 8 0 16 0 10"] + \
+                ["CREATEPENGUIN %d Jan Novak 1950-01-01 0 %d 0" % (penguin_id, penguin_id % 2)
+                 for penguin_id in range(6)] + \
+                ["REGISTERPENGUIN %d ALL DAY 1 9 0 15 0" % penguin_id for penguin_id in range(6)] + \
+                ["ENDDAY 1 3"]
+        now = NOW
+        for command in Vaccination.parse_commands(lines):
+            processor.execute(command, now=now)
+            if command.operator == "ENDDAY":
+                now = now + datetime.timedelta(days=1)
+        before = processor_statistics(processor.stats)
+
+        # ENDDAY selže až po přesunu termínů do VaccinationLog, tedy po změně statistik
+        changed = []
+
+        def failing_reprioritize(session, today, oldAge):
+            changed.append(processor_statistics(processor.stats) != before)
+            raise RuntimeError("chyba přepočtu priorit")
+
+        def rebuild(*args):
+            raise AssertionError("statistiky se nemají sestavovat z databáze")
+
+        monkeypatch.setattr(Vaccination, "reprioritize", failing_reprioritize)
+        monkeypatch.setattr(Vaccination.StatisticsStore, "from_database", rebuild)
+        with pytest.raises(RuntimeError):
+            processor.execute(Vaccination.parse_command("ENDDAY 1 3"), now=now)
+        processor.recover()
+        processor.commit()
+        monkeypatch.undo()
+
+        assert changed == [True]
+        assert processor_statistics(processor.stats) == before
+        assert before == processor_statistics(Vaccination.StatisticsStore.from_database(processor.session, 2))
+    finally:
+        processor.close()
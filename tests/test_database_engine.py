@@ -0,0 +1,37 @@
+# Testy create_database_engine: schéma se zakládá a doplňuje jen pro novou nebo starší databázi
+import sqlalchemy
+
+import Vaccination
+
+
+def schema_calls(monkeypatch):
+    calls = []
+    monkeypatch.setattr(Vaccination.meta, "create_all", lambda *args, **kwargs: calls.append("create_all"))
+    monkeypatch.setattr(Vaccination, "database_upgrade", lambda engine: calls.append("upgrade"))
+    monkeypatch.setattr(sqlalchemy.Index, "create", lambda *args, **kwargs: calls.append("index"))
+    return calls
+
+
+def test_reopened_database_skips_schema(tmp_path, monkeypatch):
+    database = "sqlite:///%s" % (tmp_path / "vakciny.db")
+    Vaccination.create_database_engine(database).dispose()
+
+    calls = schema_calls(monkeypatch)
+    Vaccination.create_database_engine(database).dispose()
+    assert calls == []
+
+
+def test_older_schema_version_is_upgraded(tmp_path, monkeypatch):
+    database = "sqlite:///%s" % (tmp_path / "vakciny.db")
+    engine = Vaccination.create_database_engine(database)
+    with engine.connect() as connection:
+        connection.exec_driver_sql("PRAGMA user_version=%d" % (Vaccination.SCHEMA_VERSION - 1))
+    engine.dispose()
+
+    calls = schema_calls(monkeypatch)
+    engine = Vaccination.create_database_engine(database)
+    with engine.connect() as connection:
+        assert Vaccination.database_schema_version(Vaccination.session_dbapi_connection(connection)) == \
+            Vaccination.SCHEMA_VERSION
+    engine.dispose()
+    assert calls[:2] == ["create_all", "upgrade"] and "index" in calls
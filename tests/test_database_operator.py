@@ -0,0 +1,22 @@
+# Testy korutiny databaseOperator: chyba příkazu uprostřed dávky
+import pytest
+import sqlalchemy
+
+import Vaccination
+
+
+def test_failed_command_keeps_earlier_writes_of_batch(tmp_path):
+    database = "sqlite:///%s" % (tmp_path / "vakciny.db")
+    operator = Vaccination.databaseOperator(2, None, 65, str(tmp_path / "output.txt"), batchSize=100,
+                                            databaseUrl=database)
+    next(operator)
+    operator.send("CREATECENTER 1 0 8 0 16 0 10")
+    operator.send("CREATEPENGUIN 1 Jan Novak 1950-01-01 0 0 0")
+    with pytest.raises(sqlalchemy.exc.IntegrityError):
+        operator.send("CREATEPENGUIN 1 Jan Novak 1950-01-01 0 0 0")
+
+    engine = sqlalchemy.create_engine(database)
+    with engine.connect() as connection:
+        assert connection.execute(sqlalchemy.select(Vaccination.penguins.c.PenguinID)).scalars().all() == [1]
+        assert connection.execute(sqlalchemy.select(Vaccination.vaccination_centers.c.CenterID)).scalars().all() == [1]
+    engine.dispose()
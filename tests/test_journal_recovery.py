@@ -0,0 +1,72 @@
+# Test obnovy z deníku příkazů: proces se zabije SIGKILL v náhodném okamžiku, spustí se znovu a po doběhnutí musí
+# být stav databáze stejný jako po běhu bez přerušení.
+#
+# Počet pokusů jde zvýšit proměnnou prostředí VAKCINY_CRASH_TRIALS, náhodu určuje VAKCINY_CRASH_SEED.
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+
+import pytest
+
+WORKER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "journal_worker.py")
+CRASH_TRIALS = int(os.environ.get("VAKCINY_CRASH_TRIALS", "6"))
+CRASH_SEED = int(os.environ.get("VAKCINY_CRASH_SEED", "0"))
+# nejvýše tolikrát se jeden běh zabije, pak se nechá doběhnout
+MAX_KILLS = 3
+
+
+def crash_start(directory, databaseUrl, batchSize, checkpointEvery):
+    return subprocess.Popen([sys.executable, WORKER, str(directory), databaseUrl, str(batchSize), str(checkpointEvery)],
+                            stdout=subprocess.PIPE, text=True)
+
+
+def crash_run(directory, databaseUrl, batchSize, checkpointEvery, rng, commandCount):
+    """Spouští pracovní proces, dokud nedoběhne; nejvýše MAX_KILLS-krát ho zabije po náhodném počtu příkazů.
+    Vrátí uložený stav a počet zabití."""
+    kills = 0
+    while True:
+        process = crash_start(directory, databaseUrl, batchSize, checkpointEvery)
+        kill_after = rng.randrange(commandCount) if kills < MAX_KILLS and rng.random() < 0.9 else None
+        for line in process.stdout:
+            if kill_after is not None and int(line) >= kill_after:
+                # proces mezitím pokračuje, zabije se tedy v libovolném místě dalšího příkazu nebo potvrzení
+                process.send_signal(signal.SIGKILL)
+                kills = kills + 1
+                break
+        process.stdout.close()
+        if process.wait() == 0:
+            break
+        assert process.returncode == -signal.SIGKILL, "pracovní proces skončil chybou"
+
+    with open(os.path.join(directory, "state.json")) as file:
+        return json.load(file), kills
+
+
+@pytest.fixture(scope="module")
+def crash_reference(tmp_path_factory):
+    """Stav po běhu bez přerušení a počet příkazů zátěže"""
+    directory = tmp_path_factory.mktemp("reference")
+    process = crash_start(directory, "sqlite:///:memory:", 1000000, None)
+    command_count = len(process.stdout.readlines())
+    process.stdout.close()
+    assert process.wait() == 0
+    with open(os.path.join(directory, "state.json")) as file:
+        return json.load(file), command_count
+
+
+@pytest.mark.parametrize("trial", range(CRASH_TRIALS))
+def test_recovery_after_kill(tmp_path, crash_reference, trial):
+    reference, command_count = crash_reference
+    rng = random.Random(CRASH_SEED * 1000 + trial)
+    databaseUrl = rng.choice(["sqlite:///:memory:", "sqlite:///%s" % (tmp_path / "vakciny.db")])
+    batchSize = rng.choice([1, 7, 50, 1000])
+    checkpointEvery = rng.choice([None, 40, 300])
+
+    state, kills = crash_run(tmp_path, databaseUrl, batchSize, checkpointEvery, rng, command_count)
+
+    differing = [table for table in reference if state.get(table) != reference[table]]
+    assert differing == [], "%s batchSize=%d checkpointEvery=%s, %d× zabito: liší se %s" \
+        % (databaseUrl, batchSize, checkpointEvery, kills, differing)
@@ -0,0 +1,87 @@
+# Plány dotazů: žádný SQL příkaz, který program při zpracování příkazů opravdu provede, nesmí procházet celou
+# tabulku, pokud to není jeho účel (ALLOWED_FULL_SCANS).
+#
+# Test nechá projít syntetickou zátěž (se simulovaným datem, takže ENDDAY přesouvá termíny do VaccinationLog) a
+# zachytí každý provedený dotaz i s parametry a funkcí modulu Vaccination, která ho provedla. Pro každý pak spustí
+# EXPLAIN QUERY PLAN. Plán bez ANALYZE nezávisí na datech, stačí proto malá zátěž.
+import datetime
+import sys
+
+from sqlalchemy import event
+
+import Vaccination
+import Workload
+
+WORKLOAD_START = datetime.datetime(2021, 3, 22, 10, 0)
+
+# funkce -> tabulky, které smí projít celé, protože s nimi pracuje celými
+ALLOWED_FULL_SCANS = {
+    "reprioritize": {"Penguin"},                    # přepočet priority všech tučňáků
+    "endday_candidates": {"ValidCenters"},          # kandidáti pro všechna centra najednou
+    "endday_schedule": {"VaccinationCenter", "WaitingList"},    # všechna centra a časy všech čekajících
+    "from_timetable": {"TimeTable"},                # obsazenost ze všech budoucích termínů (minulé jsou v logu)
+    "printregistered_rows": {"WaitingList"},        # čte v pořadí RegistrationID a skončí po LIMIT řádcích
+}
+
+
+def query_plans_capture(engine, statements):
+    """Zachytává provedené dotazy: text -> (parametry, nejbližší volající funkce z Vaccination)"""
+    @event.listens_for(engine, "before_cursor_execute")
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")):
+            statements.setdefault(statement, (parameters[0] if executemany else parameters, query_plans_caller()))
+
+
+def query_plans_caller():
+    frame = sys._getframe(2)
+    while frame is not None and (frame.f_globals.get("__name__") != Vaccination.__name__
+                                 or frame.f_code.co_name.startswith("<")):     # ne <listcomp> apod.
+        frame = frame.f_back
+    return frame.f_code.co_name if frame is not None else None
+
+
+def query_plans_run(commands, statements):
+    processor = Vaccination.CommandProcessor(2, 65, Vaccination.CapturedOutput(), batchSize=10)
+    query_plans_capture(processor.engine, statements)
+    now = WORKLOAD_START
+    try:
+        for command in commands:
+            processor.execute(command, now=now)
+            if command.operator == "ENDDAY":
+                now = now + datetime.timedelta(days=1)
+        processor.commit()
+        connection = Vaccination.session_dbapi_connection(processor.session)
+        return {statement: (caller, [row[-1] for row in connection.execute("EXPLAIN QUERY PLAN " + statement,
+                                                                            parameters)])
+                for statement, (parameters, caller) in statements.items()}
+    finally:
+        processor.close()
+
+
+def query_plans_full_scans(plan):
+    """Tabulky, které plán prochází celé (SCAN tabulky i SCAN celého indexu; ne SCAN mezivýsledku poddotazu)"""
+    tables = {table.name for table in Vaccination.meta.sorted_tables}
+    return {detail.split(" ")[1] for detail in plan
+            if detail.startswith("SCAN ") and detail.split(" ")[1] in tables}
+
+
+def test_no_unexpected_full_scans():
+    lines = list(Workload.generate_workload(300, 8, 3, 4, seed=1, queriesPerDay=80, today=WORKLOAD_START.date()))
+    lines = lines + ["REPRIORITIZE", "PRINTREGISTERED 5 AFTER 10", "FINDLOGGEDVACCINATIONS DATE 2021 03 23 LEVEL 1"]
+    commands = Vaccination.parse_commands(lines)
+
+    plans = query_plans_run(commands, {})
+    # stejná zátěž s hromadnými REGISTERPENGUINS
+    plans.update(query_plans_run(Vaccination.batch_registrations(commands), {}))
+
+    callers = {caller for caller, plan in plans.values()}
+    for function in ("endday_candidates", "endday_rollover", "find_query", "printvalidtimes_query",
+                     "registerpenguins"):
+        assert function in callers, "zátěž neprovedla %s" % function
+
+    unexpected = {}
+    for statement, (caller, plan) in plans.items():
+        scanned = query_plans_full_scans(plan) - ALLOWED_FULL_SCANS.get(caller, set())
+        if scanned:
+            unexpected[" ".join(statement.split())] = (caller, plan)
+    assert unexpected == {}
@@ -0,0 +1,52 @@
+# Hromadná registrace (REGISTERPENGUINS) musí dát stejný stav jako registrace po jedné, i v okrajových případech
+import datetime
+
+import sqlalchemy
+
+import Vaccination
+
+NOW = datetime.datetime(2021, 3, 22, 10, 0)
+
+SETUP = ["CREATECENTER 1 0 8 0 16 0 10",
+         "CREATECENTER 2 0 8 0 16 0 10",
+         "CREATECENTER 3 0 12 0 18 0 10",     # v 10:00 ještě zavřeno
+         "CREATECENTER 4 1 8 0 16 0 10"]      # jiný okrsek
+
+REGISTRATIONS = ["REGISTERPENGUIN %d ALL ALWAYS",
+                 "REGISTERPENGUIN %d ALL CENTERS 1 ALWAYS",          # zadané centrum je i mezi otevřenými
+                 "REGISTERPENGUIN %d ALL CENTERS 3 4 DAY 1",         # zavřené a cizí centrum navíc
+                 "REGISTERPENGUIN %d ALL CENTERS 99 ALWAYS",         # zadané centrum neexistuje
+                 "REGISTERPENGUIN %d CENTERS 99 98 ALWAYS",          # žádné ze zadaných neexistuje
+                 "REGISTERPENGUIN %d CENTERS 2 2 99 DAY 3 8 0 9 0",  # opakované a neexistující centrum
+                 "REGISTERPENGUIN %d CENTERS 3 1 ALWAYS"]
+
+
+def registration_state(commands):
+    processor = Vaccination.CommandProcessor(2, 65, Vaccination.CapturedOutput())
+    try:
+        for command in commands:
+            processor.execute(command, now=NOW)
+        processor.commit()
+        return {table.name: sorted(tuple(str(value) for value in row)
+                                   for row in processor.session.execute(sqlalchemy.select(table)))
+                for table in (Vaccination.waiting_list, Vaccination.valid_centers, Vaccination.valid_times)}
+    finally:
+        processor.close()
+
+
+def test_bulk_registration_equals_single():
+    lines = SETUP + ["CREATEPENGUIN %d Jan Novak 1950-01-01 0 0 0" % penguin_id
+                     for penguin_id in range(len(REGISTRATIONS))]
+    lines = lines + [registration % penguin_id for penguin_id, registration in enumerate(REGISTRATIONS)]
+    commands = Vaccination.parse_commands(lines)
+
+    single = registration_state(commands)
+    bulk = registration_state(Vaccination.batch_registrations(commands))
+    assert bulk == single
+    assert len(single["WaitingList"]) == len(REGISTRATIONS)
+
+
+def test_registration_centers():
+    lines = SETUP + ["CREATEPENGUIN 0 Jan Novak 1950-01-01 0 0 0", "REGISTERPENGUIN 0 ALL CENTERS 1 3 99 ALWAYS"]
+    state = registration_state(Vaccination.parse_commands(lines))
+    assert state["ValidCenters"] == [("0", "1"), ("0", "2"), ("0", "3")]
@@ -0,0 +1,67 @@
+# Testy serveru: odpovědi na pipelinované příkazy a trvanlivost potvrzených zápisů
+import asyncio
+
+import AsyncOperator
+import Server
+
+
+async def server_exchange(operator, path, lines):
+    """Pošle všechny řádky najednou (bez čekání na odpovědi) a vrátí odpovědi jako seznam (stav, řádky výstupu)"""
+    server = await Server.serve(operator, unixPath=path)
+    try:
+        reader, writer = await asyncio.open_unix_connection(path)
+        writer.write("".join(line + "\n" for line in lines).encode())
+        await writer.drain()
+        replies = []
+        for line in lines:
+            status = (await reader.readline()).decode().rstrip("\n")
+            output = []
+            if status.startswith("OK "):
+                for index in range(int(status.split(" ")[1])):
+                    output.append((await reader.readline()).decode().rstrip("\n"))
+            replies.append((status, output))
+        writer.close()
+        await writer.wait_closed()
+        return replies
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+def server_run(tmp_path, lines, databaseUrl):
+    async def main():
+        async with AsyncOperator.AsyncOperator(2, 65, str(tmp_path / "output.txt"), batchSize=100,
+                                               databaseUrl=databaseUrl) as operator:
+            return await server_exchange(operator, str(tmp_path / "server.sock"), lines)
+    return asyncio.run(main())
+
+
+def check_failed_command_keeps_earlier_writes(tmp_path, databaseUrl):
+    # všechny zápisy jsou v jedné dávce (batchSize=100), chyba druhého CREATEPENGUIN nesmí vrátit dřívější zápisy
+    replies = server_run(tmp_path, ["CREATECENTER 1 0 8 0 16 0 10",
+                                    "CREATEPENGUIN 1 Jan Novak 1950-01-01 0 0 0",
+                                    "CREATEPENGUIN 1 Jan Novak 1950-01-01 0 0 0",
+                                    "REGISTERPENGUIN 1 ALL ALWAYS",
+                                    "PRINTFREECENTERS 0",
+                                    "PRINTREGISTERED 5"], databaseUrl)
+
+    assert replies[0] == ("OK 0", [])
+    assert replies[1] == ("OK 0", [])
+    assert replies[2][0].startswith("ERR IntegrityError")
+    assert replies[3] == ("OK 0", [])
+    assert replies[4] == ("OK 1", ["1"])
+    assert replies[5][0] == "OK 1" and replies[5][1][0].endswith("|1|Jan|Novak|2")
+
+
+def test_failed_command_keeps_earlier_writes_in_memory(tmp_path):
+    check_failed_command_keeps_earlier_writes(tmp_path, "sqlite:///:memory:")
+
+
+def test_failed_command_keeps_earlier_writes_in_file(tmp_path):
+    check_failed_command_keeps_earlier_writes(tmp_path, "sqlite:///%s" % (tmp_path / "vakciny.db"))
+
+    # potvrzené zápisy přežijí i restart
+    replies = server_run(tmp_path, ["PRINTFREECENTERS 0", "PRINTREGISTERED 5"],
+                         "sqlite:///%s" % (tmp_path / "vakciny.db"))
+    assert replies[0] == ("OK 1", ["1"])
+    assert replies[1][0] == "OK 1"
@@ -0,0 +1,340 @@
+# Sloupcový export a vektorové analýzy nad historií očkování
+#
+# Poznámka k řešení: Tabulky VaccinationLog, TimeTable, Penguin a VaccinationCenter se čtou po blocích
+# (EXPORT_CHUNK_SIZE řádků) rovnou do NumPy polí. Dotaz se sestaví přes SQLAlchemy, ale čte se přímo kurzorem sqlite3
+# (bez ORM objektů i bez řádků SQLAlchemy) a časy se nepřevádějí na datetime: SQLite je vrací jako celé sekundy
+# od 1970 (strftime('%s')). Bloky lze zapsat do Parquet souborů (potřebuje pyarrow),
+# nebo spojit do jedněch polí pro každý sloupec (export_arrays).
+#
+# Analýzy pracují nad těmito poli celé najednou (numpy.unique, bincount, searchsorted), žádná nejde po řádcích.
+# analytics_statistics vrací stejné hodnoty jako GIVESTATISTICS, ostatní funkce vrací počty podle okrsku, centra,
+# dne a dne v týdnu jako dvojici polí (klíče, počty).
+#
+# Databáze se otevírá jen pro čtení (analytics_engine), analýzy ji nijak nemění ani nezakládají. Snímek ze SNAPSHOT
+# (--snapshot) se načte do paměti; tak jde analyzovat i databázi od starší verze schématu, která se v paměti doplní.
+#
+# Použití: python Analytics.py sqlite:///vakciny.db [--parquet slozka] [--vaccinations-limit 2]
+#          python Analytics.py --snapshot snimek.db
+
+# Imports
+import argparse
+import datetime
+import json
+import os
+import sys
+import time
+import urllib.parse
+
+import numpy
+import sqlalchemy
+from sqlalchemy import Integer, cast, func
+from sqlalchemy.dialects import sqlite
+
+import Vaccination
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:     # pyarrow je potřeba jen pro export do Parquet
+    pyarrow = None
+
+EXPORT_CHUNK_SIZE = 100000
+# rozsah klíčů, do kterého se počty počítají přes bincount i pro málo záznamů
+DENSE_KEYS = 1 << 16
+SECONDS_PER_DAY = 24 * 60 * 60
+EPOCH = datetime.datetime(1970, 1, 1)
+EPOCH_WEEKDAY = 3   # 1. 1. 1970 byl čtvrtek (pondělí = 0)
+
+
+def export_columns():
+    """Exportované tabulky: jméno -> seznam (sloupec, výraz v dotazu, typ NumPy). Časy jsou sekundy od 1970."""
+    def seconds(column):
+        return cast(func.strftime('%s', column), Integer)
+
+    log = Vaccination.vaccination_log.c
+    timetable = Vaccination.timetable.c
+    penguins = Vaccination.penguins.c
+    centers = Vaccination.vaccination_centers.c
+    return {
+        "VaccinationLog": [("RegistrationID", log.RegistrationID, numpy.int64),
+                           ("PenguinID", log.PenguinID, numpy.int64),
+                           ("VaccinationNumber", log.VaccinationNumber, numpy.int32),
+                           ("VaccinationCenter", log.VaccinationCenter, numpy.int64),
+                           ("VaccinationTime", seconds(log.VaccinationTime), numpy.int64)],
+        "TimeTable": [("RegistrationID", timetable.RegistrationID, numpy.int64),
+                      ("VaccinationCenterID", timetable.VaccinationCenterID, numpy.int64),
+                      ("Time", seconds(timetable.Time), numpy.int64),
+                      ("PenguinID", timetable.PenguinID, numpy.int64)],
+        "Penguin": [("PenguinID", penguins.PenguinID, numpy.int64),
+                    ("Birthday", seconds(penguins.Birthday), numpy.int64),
+                    ("District", penguins.District, numpy.int64),
+                    ("VaccineNumber", penguins.VaccineNumber, numpy.int32),
+                    ("PenguinPriority", penguins.PenguinPriority, numpy.int32),
+                    ("Medic", penguins.Medic, numpy.int32)],
+        "VaccinationCenter": [("CenterID", centers.CenterID, numpy.int64),
+                              ("District", centers.District, numpy.int64),
+                              ("FreeVaccines", centers.FreeVaccines, numpy.int64)],
+    }
+
+
+EXPORT_TABLES = ("VaccinationLog", "TimeTable", "Penguin", "VaccinationCenter")
+
+
+def analytics_engine(databaseUrl):
+    """Otevře souborovou SQLite databázi jen pro čtení (na rozdíl od Vaccination.create_database_engine nezakládá
+    chybějící soubor ani tabulky a nic nedoplňuje). Nepodporovanou databázi odmítne s ValueError."""
+    url = sqlalchemy.engine.make_url(databaseUrl)
+    if not Vaccination.database_file_backed(url):
+        raise ValueError("analýzy potřebují souborovou SQLite databázi (databázi v paměti lze načíst přes --snapshot)")
+    if not os.path.isfile(url.database):
+        raise ValueError("databáze %s neexistuje" % url.database)
+
+    engine = sqlalchemy.create_engine("sqlite:///file:%s?mode=ro&uri=true"
+                                      % urllib.parse.quote(os.path.abspath(url.database)))
+    try:
+        with engine.connect() as connection:
+            version = Vaccination.database_schema_version(Vaccination.session_dbapi_connection(connection))
+            has_tables = all(sqlalchemy.inspect(connection).has_table(table) for table in EXPORT_TABLES)
+    except sqlalchemy.exc.DatabaseError:
+        engine.dispose()
+        raise ValueError("soubor %s není databáze" % url.database)
+    if not has_tables:
+        engine.dispose()
+        raise ValueError("%s není databáze vakcinačního systému" % url.database)
+    if version != Vaccination.SCHEMA_VERSION:
+        engine.dispose()
+        raise ValueError("databáze %s má verzi schématu %d (podporovaná je %d), načtěte ji přes --snapshot"
+                         % (url.database, version, Vaccination.SCHEMA_VERSION))
+    return engine
+
+
+def export_chunks(session, table, chunkSize=EXPORT_CHUNK_SIZE):
+    """Vrací tabulku po blocích jako slovníky sloupec -> numpy pole (nejvýše chunkSize řádků v bloku)"""
+    columns = export_columns()[table]
+    dtype = numpy.dtype([(name, column_type) for name, expression, column_type in columns])
+    query = sqlalchemy.select(*[expression for name, expression, column_type in columns]).compile(
+        dialect=sqlite.dialect())
+    cursor = Vaccination.session_dbapi_connection(session).cursor()
+    try:
+        cursor.execute(str(query), [query.params[name] for name in query.positiontup])
+        while True:
+            rows = cursor.fetchmany(chunkSize)
+            if not rows:
+                return
+            records = numpy.array(rows, dtype=dtype)
+            yield {name: records[name] for name in dtype.names}
+    finally:
+        cursor.close()
+
+
+def export_arrays(session, tables=EXPORT_TABLES, chunkSize=EXPORT_CHUNK_SIZE):
+    """Načte tabulky do paměti: jméno tabulky -> {sloupec: numpy pole}"""
+    arrays = {}
+    for table in tables:
+        chunks = list(export_chunks(session, table, chunkSize))
+        arrays[table] = {name: numpy.concatenate([chunk[name] for chunk in chunks]) if chunks
+                         else numpy.empty(0, dtype=column_type)
+                         for name, expression, column_type in export_columns()[table]}
+    return arrays
+
+
+def export_parquet(session, directory, tables=EXPORT_TABLES, chunkSize=EXPORT_CHUNK_SIZE):
+    """Zapíše tabulky do directory/<tabulka>.parquet, každý blok jako jednu row group. Vrátí počty řádků."""
+    if pyarrow is None:
+        raise RuntimeError("export do Parquet potřebuje balíček pyarrow")
+
+    os.makedirs(directory, exist_ok=True)
+    counts = {}
+    for table in tables:
+        columns = export_columns()[table]
+        schema = pyarrow.schema([(name, pyarrow.from_numpy_dtype(numpy.dtype(column_type)))
+                                 for name, expression, column_type in columns])
+        counts[table] = 0
+        with pyarrow.parquet.ParquetWriter(os.path.join(directory, table + ".parquet"), schema) as writer:
+            for chunk in export_chunks(session, table, chunkSize):
+                writer.write_batch(pyarrow.record_batch([chunk[name] for name in schema.names], schema=schema))
+                counts[table] += len(chunk[schema.names[0]])
+    return counts
+
+
+def load_parquet(directory, tables=EXPORT_TABLES):
+    """Načte tabulky zapsané export_parquet ve stejném tvaru, jaký vrací export_arrays"""
+    if pyarrow is None:
+        raise RuntimeError("čtení Parquet potřebuje balíček pyarrow")
+    arrays = {}
+    for table in tables:
+        data = pyarrow.parquet.read_table(os.path.join(directory, table + ".parquet"))
+        arrays[table] = {name: data.column(name).to_numpy() for name in data.column_names}
+    return arrays
+
+
+# --------------------------------------------------------------------------------------------------------
+# ANALYZY
+# --------------------------------------------------------------------------------------------------------
+
+
+def analytics_counts(keys):
+    """Počty výskytů každého klíče: (seřazené klíče, počty). Hustě rozložené celočíselné klíče (id, dny) se počítají
+    přes bincount v lineárním čase, ostatní přes řazení (numpy.unique)."""
+    if len(keys) == 0:
+        return keys[:0], numpy.zeros(0, dtype=numpy.int64)
+    low = keys.min()
+    if keys.max() - low <= max(len(keys), DENSE_KEYS):
+        counts = numpy.bincount(keys - low)
+        present = numpy.flatnonzero(counts)
+        return present + low, counts[present]
+    return numpy.unique(keys, return_counts=True)
+
+
+def analytics_days(seconds):
+    """Sekundy od 1970 -> číslo dne od 1970"""
+    return seconds // SECONDS_PER_DAY
+
+
+def analytics_center_districts(arrays, center_ids):
+    """Okrsek centra pro každé id v center_ids (centra, která už neexistují, mají okrsek -1)"""
+    centers = arrays["VaccinationCenter"]
+    if len(centers["CenterID"]) == 0:
+        return numpy.full(len(center_ids), -1, dtype=numpy.int64)
+    order = numpy.argsort(centers["CenterID"])
+    sorted_ids = centers["CenterID"][order]
+    positions = numpy.minimum(numpy.searchsorted(sorted_ids, center_ids), len(sorted_ids) - 1)
+    found = sorted_ids[positions] == center_ids
+    return numpy.where(found, centers["District"][order][positions], -1)
+
+
+def analytics_by_district(arrays):
+    """Záznamy VaccinationLog podle okrsku centra"""
+    log = arrays["VaccinationLog"]
+    districts = analytics_center_districts(arrays, log["VaccinationCenter"])
+    return analytics_counts(districts[districts >= 0])
+
+
+def analytics_by_center(arrays):
+    """Záznamy VaccinationLog podle centra"""
+    return analytics_counts(arrays["VaccinationLog"]["VaccinationCenter"])
+
+
+def analytics_by_day(arrays, table="VaccinationLog"):
+    """Záznamy VaccinationLog (nebo TimeTable) podle dne; klíče jsou numpy.datetime64 dny"""
+    column = "VaccinationTime" if table == "VaccinationLog" else "Time"
+    days, counts = analytics_counts(analytics_days(arrays[table][column]))
+    return days.astype("datetime64[D]"), counts
+
+
+def analytics_by_weekday(arrays, includeTimetable=True):
+    """Záznamy VaccinationLog (a naplánované termíny z TimeTable) podle dne v týdnu, pondělí = 0. Vrací 7 počtů."""
+    seconds = arrays["VaccinationLog"]["VaccinationTime"]
+    if includeTimetable:
+        seconds = numpy.concatenate([seconds, arrays["TimeTable"]["Time"]])
+    return numpy.bincount((analytics_days(seconds) + EPOCH_WEEKDAY) % 7, minlength=7)
+
+
+def analytics_fully_vaccinated_by_district(arrays, vaccinationsLimit):
+    """Plně očkovaní tučňáci (VaccineNumber == vaccinationsLimit) podle okrsku"""
+    penguins = arrays["Penguin"]
+    return analytics_counts(penguins["District"][penguins["VaccineNumber"] == vaccinationsLimit])
+
+
+def analytics_first_fully_vaccinated(arrays, vaccinationsLimit):
+    """První záznam VaccinationLog, kterým tučňák dosáhl vaccinationsLimit: (čas v sekundách, RegistrationID,
+    PenguinID), nebo None"""
+    log = arrays["VaccinationLog"]
+    selected = numpy.flatnonzero(log["VaccinationNumber"] == vaccinationsLimit)
+    if len(selected) == 0:
+        return None
+    # lexsort řadí podle posledního klíče: čas, při shodě RegistrationID
+    first = selected[numpy.lexsort((log["RegistrationID"][selected], log["VaccinationTime"][selected]))[0]]
+    return int(log["VaccinationTime"][first]), int(log["RegistrationID"][first]), int(log["PenguinID"][first])
+
+
+def analytics_most_common(keys, counts, default=None):
+    """Klíč s nejvyšším počtem, při shodě nejmenší (stejně jako most_common_key v Vaccination)"""
+    if len(counts) == 0 or counts.max() <= 0:
+        return default
+    return keys[numpy.flatnonzero(counts == counts.max())].min()
+
+
+def analytics_statistics(arrays, vaccinationsLimit):
+    """Stejné údaje jako GIVESTATISTICS, spočítané z exportovaných polí"""
+    log_days, log_counts = analytics_by_day(arrays, "VaccinationLog")
+    timetable_days, timetable_counts = analytics_by_day(arrays, "TimeTable")
+    favourite_day = analytics_most_common(log_days, log_counts)
+    timetable_day = analytics_most_common(timetable_days, timetable_counts)
+    if timetable_day is not None and (favourite_day is None or
+                                      timetable_counts.max() > log_counts[log_days == favourite_day][0]):
+        favourite_day = timetable_day
+
+    first = analytics_first_fully_vaccinated(arrays, vaccinationsLimit)
+    weekdays = analytics_by_weekday(arrays)
+    return {
+        "vaccinated_penguins": len(analytics_counts(arrays["VaccinationLog"]["PenguinID"])[0]),
+        "best_vaccinated_district": analytics_key(analytics_most_common(
+            *analytics_fully_vaccinated_by_district(arrays, vaccinationsLimit))),
+        "favourite_district": analytics_key(analytics_most_common(*analytics_by_district(arrays))),
+        "favourite_center": analytics_key(analytics_most_common(*analytics_by_center(arrays))),
+        "first_fully_vaccinated": first[2] if first is not None else None,
+        "favourite_day": favourite_day.item() if favourite_day is not None else None,
+        "favourite_weekday": analytics_key(analytics_most_common(numpy.arange(7), weekdays, 0)),
+    }
+
+
+def analytics_key(value):
+    """numpy skalár -> obyčejné číslo Pythonu (pro výpis a JSON)"""
+    return value.item() if isinstance(value, numpy.generic) else value
+
+
+def analytics_report(arrays, vaccinationsLimit):
+    """Souhrn všech analýz jako slovník pro JSON"""
+    def pairs(keys, counts):
+        return {str(analytics_key(key)): int(count) for key, count in zip(keys, counts)}
+
+    statistics = analytics_statistics(arrays, vaccinationsLimit)
+    if statistics["favourite_day"] is not None:
+        statistics["favourite_day"] = statistics["favourite_day"].isoformat()
+    first = analytics_first_fully_vaccinated(arrays, vaccinationsLimit)
+    return {
+        "statistics": statistics,
+        "first_fully_vaccinated_time": (EPOCH + datetime.timedelta(seconds=first[0])).isoformat() if first else None,
+        "by_district": pairs(*analytics_by_district(arrays)),
+        "by_center": pairs(*analytics_by_center(arrays)),
+        "by_day": pairs(*analytics_by_day(arrays)),
+        "by_weekday": [int(count) for count in analytics_by_weekday(arrays)],
+        "fully_vaccinated_by_district": pairs(*analytics_fully_vaccinated_by_district(arrays, vaccinationsLimit)),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sloupcový export a analýzy historie očkování")
+    parser.add_argument("database", nargs="?", default=None,
+                        help="URL souborové databáze, např. sqlite:///vakciny.db (otevře se jen pro čtení)")
+    parser.add_argument("--snapshot", default=None, help="snímek z příkazu SNAPSHOT, který se načte do paměti")
+    parser.add_argument("--parquet", default=None, help="složka, do které se tabulky zapíšou jako Parquet")
+    parser.add_argument("--vaccinations-limit", type=int, default=2)
+    args = parser.parse_args()
+    if (args.database is None) == (args.snapshot is None):
+        parser.error("zadejte buď databázi, nebo --snapshot")
+
+    try:
+        if args.snapshot is not None:
+            engine = Vaccination.create_database_engine("sqlite:///:memory:", snapshotFile=args.snapshot)
+        else:
+            engine = analytics_engine(args.database)
+    except ValueError as exception:
+        parser.error(str(exception))
+    with engine.connect() as connection:
+        started = time.perf_counter()
+        if args.parquet is not None:
+            counts = export_parquet(connection, args.parquet)
+            print("export do %s: %s (%.2f s)" % (args.parquet, counts, time.perf_counter() - started), file=sys.stderr)
+            started = time.perf_counter()
+            arrays = load_parquet(args.parquet)
+        else:
+            arrays = export_arrays(connection)
+        loaded = time.perf_counter()
+        report = analytics_report(arrays, args.vaccinations_limit)
+        print("načtení %.2f s, analýzy %.3f s" % (loaded - started, time.perf_counter() - loaded), file=sys.stderr)
+    engine.dispose()
+
+    json.dump(report, sys.stdout, indent=2)
+    print()
@@ -0,0 +1,240 @@
+# Asynchronní rozhraní ke zpracování příkazů
+#
+# Poznámka k řešení: Příkazy může posílat libovolně mnoho korutin najednou (AsyncOperator.submit), každý příkaz dostane
+# pořadové číslo podle toho, kdy byl přijat. Zápisy (a GIVESTATISTICS, které čte statistiky v paměti) provádí jeden
+# zapisovač ve vlastním vlákně přes CommandProcessor, stejně jako korutina databaseOperator. Čtecí příkazy
+# PRINT*/FIND* a SNAPSHOT se u souborové databáze provádějí souběžně ve vláknech s vlastními spojeními.
+#
+# Výsledek je stejný, jako kdyby se příkazy prováděly postupně v pořadí přijetí:
+# - čtení začne až po potvrzení všech zápisů přijatých před ním,
+# - čtení běží v jedné transakci, tedy nad jedním snímkem databáze (SQLite ve WAL režimu),
+# - zapisovač nepustí zápis přijatý po čtení dřív, než si čtení svůj snímek vezme,
+# - výstup příkazů se do souboru zapisuje v pořadí přijetí, i když příkazy doběhnou v jiném pořadí.
+#
+# Volající dostane text výstupu svého příkazu hned, jak příkaz doběhne, pomalé čtení tak nezdrží potvrzení zápisů.
+# U databáze v paměti jdou přes zapisovač všechny příkazy (jiné spojení by vidělo jinou, prázdnou databázi).
+
+# Imports
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import Vaccination
+
+# Příkazy, které jen čtou databázi a mohou se provádět souběžně; všechny mají tvar funkce(session, command, output)
+CONCURRENT_READS = {
+    "PRINTREGISTERED": Vaccination.printregistered,
+    "PRINTFREECENTERS": Vaccination.printfreecenters,
+    "PRINTVALIDTIMES": Vaccination.printvalidtimes,
+    "FINDAPPOINTMENTS": Vaccination.findappointments,
+    "FINDLOGGEDVACCINATIONS": Vaccination.findloggedvaccinations,
+    "SNAPSHOT": Vaccination.snapshot,
+}
+
+
+class AsyncOperator:
+    """Asynchronní obdoba korutiny databaseOperator.
+
+    Použití:
+        async with AsyncOperator(2, 65, "vystup.txt", databaseUrl="sqlite:///vakciny.db") as operator:
+            text = await operator.submit("PRINTREGISTERED 10")
+    """
+
+    def __init__(self, vaccinationsLimit, oldAge, printFile, readWorkers=4, batchSize=1, batchInterval=None,
+                 databaseUrl='sqlite:///:memory:', schedulingWorkers=None, outputFlushEvery=1, metricsFile=None,
+                 profileOperators=(), snapshotFile=None, journalFile=None, checkpointFile=None,
+                 checkpointEvery=None):
+        """:param readWorkers: počet vláken pro souběžná čtení (0 = vše přes zapisovač)
+
+        Ostatní parametry mají stejný význam jako u databaseOperator. Při chybě příkazu se zahodí jen jeho změny,
+        potvrzené zápisy dřívějších příkazů téže dávky zůstanou (CommandProcessor je chrání savepointem)."""
+        self.processor_args = (vaccinationsLimit, oldAge, None, batchSize, batchInterval, databaseUrl,
+                               schedulingWorkers, profileOperators, snapshotFile, journalFile, checkpointFile,
+                               checkpointEvery)
+        self.print_file = printFile
+        self.output_flush_every = outputFlushEvery
+        self.metrics_file = metricsFile
+        self.database_url = databaseUrl
+        self.concurrent_reads = readWorkers > 0 and Vaccination.database_file_backed(databaseUrl)
+        self.read_workers = readWorkers
+
+        self.loop = None
+        self.writer = None          # vlákno zapisovače (všechna volání CommandProcessor)
+        self.readers = None         # vlákna pro souběžná čtení
+        self.read_engine = None
+        self.processor = None
+        self.output = None
+
+        self.sequence = 0           # pořadí posledního přijatého příkazu
+        self.last_write = 0         # pořadí posledního přijatého zápisu
+        self.executed_write = 0     # pořadí posledního provedeného zápisu
+        self.committed = 0          # pořadí zápisu, do kterého je vše potvrzené
+        self.committed_changed = None
+        self.waiting_reads = 0      # čtení, která čekají na potvrzení zápisů
+        self.read_started = {}      # pořadí čtení -> future, která se dokončí, až má čtení snímek databáze
+        self.read_tasks = set()
+        self.writes = None
+        self.writer_task = None
+        self.outputs = {}           # pořadí -> zachycený výstup doběhnutého příkazu, který ještě není v souboru
+        self.next_output = 1
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        await self.close()
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.committed_changed = asyncio.Condition()
+        self.writes = asyncio.Queue()
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="vakciny-writer")
+        self.output = Vaccination.OutputWriter(self.print_file, self.output_flush_every)
+        self.processor = await self.in_writer(Vaccination.CommandProcessor, *self.processor_args)
+        if self.concurrent_reads:
+            self.readers = ThreadPoolExecutor(max_workers=self.read_workers, thread_name_prefix="vakciny-reader")
+            self.read_engine = Vaccination.create_database_engine(self.database_url, self.processor.metrics,
+                                                                  sharedByThreads=True)
+        self.writer_task = self.loop.create_task(self.write_loop())
+
+    async def submit(self, command):
+        """Zařadí příkaz (řádek nebo objekt z parse_command) a počká, až doběhne. Vrátí text jeho výstupu."""
+        return await asyncio.shield(self.enqueue(command))
+
+    def enqueue(self, command):
+        """Zařadí příkaz hned (pořadí podle volání enqueue) a vrátí future s textem jeho výstupu"""
+        if isinstance(command, str):
+            command = Vaccination.parse_command(command)
+
+        self.sequence = self.sequence + 1
+        sequence = self.sequence
+        future = self.loop.create_future()
+        if command is None:     # neznámý příkaz se ignoruje
+            self.complete(sequence, Vaccination.CapturedOutput(), future)
+        elif self.concurrent_reads and command.operator in CONCURRENT_READS:
+            self.read_started[sequence] = self.loop.create_future()
+            task = self.loop.create_task(self.read(sequence, self.last_write, command, future))
+            self.read_tasks.add(task)
+            task.add_done_callback(self.read_tasks.discard)
+        else:
+            self.last_write = sequence
+            self.writes.put_nowait((sequence, command, future))
+        return future
+
+    async def close(self):
+        """Počká na všechny přijaté příkazy, potvrdí transakci a vše uzavře"""
+        self.writes.put_nowait((None, None, None))
+        await self.writer_task
+        if self.read_tasks:
+            await asyncio.gather(*self.read_tasks)
+        try:
+            await self.in_writer(self.processor.commit)
+            if self.metrics_file is not None:
+                await self.in_writer(self.dump_metrics)
+        finally:
+            self.output.close()
+            await self.in_writer(self.processor.close)
+            self.writer.shutdown()
+            if self.readers is not None:
+                self.readers.shutdown()
+                self.read_engine.dispose()
+
+    async def write_loop(self):
+        while True:
+            sequence, command, future = await self.writes.get()
+            if command is None:
+                await self.commit()
+                return
+
+            # čtení přijatá před tímto zápisem musí mít snímek databáze dřív, než se zápis potvrdí
+            earlier = [started for read_sequence, started in self.read_started.items() if read_sequence < sequence]
+            if earlier:
+                await self.commit()
+                await asyncio.gather(*earlier)
+
+            captured = Vaccination.CapturedOutput()
+            error = None
+            try:
+                await self.in_writer(self.processor.execute, command, captured)
+            except Exception as exception:
+                error = exception
+                await self.in_writer(self.processor.recover)
+            self.executed_write = sequence
+
+            if self.waiting_reads > 0 or self.writes.empty():
+                await self.commit()
+            elif self.processor.pending_commands == 0:     # dávku potvrdil sám CommandProcessor
+                await self.set_committed(sequence)
+            self.complete(sequence, captured, future, error)
+
+    async def commit(self):
+        """Potvrdí rozpracovanou dávku zapisovače a pustí čtení, která na ni čekají"""
+        await self.in_writer(self.processor.commit_pending)
+        await self.set_committed(self.executed_write)
+
+    async def set_committed(self, sequence):
+        async with self.committed_changed:
+            self.committed = max(self.committed, sequence)
+            self.committed_changed.notify_all()
+
+    async def read(self, sequence, barrier, command, future):
+        """Čtecí příkaz: počká na potvrzení zápisů přijatých před ním (barrier) a provede se ve čtecím vlákně"""
+        started = self.read_started[sequence]
+        async with self.committed_changed:
+            self.waiting_reads = self.waiting_reads + 1
+            await self.committed_changed.wait_for(lambda: self.committed >= barrier)
+            self.waiting_reads = self.waiting_reads - 1
+
+        captured = Vaccination.CapturedOutput()
+        error = None
+        try:
+            await self.loop.run_in_executor(self.readers, self.read_snapshot, command, captured, started)
+        except Exception as exception:
+            error = exception
+        finally:
+            future_set_result(started)
+            del self.read_started[sequence]
+        self.complete(sequence, captured, future, error)
+
+    def read_snapshot(self, command, captured, started):
+        """Provede čtecí příkaz v jedné transakci (ve čtecím vlákně)"""
+        with self.read_engine.connect() as connection:
+            connection.exec_driver_sql("BEGIN")
+            try:
+                # prvním čtením si SQLite vezme snímek databáze, od té doby může zapisovač potvrzovat další zápisy
+                connection.exec_driver_sql("SELECT count(*) FROM sqlite_master").scalar()
+                self.loop.call_soon_threadsafe(future_set_result, started)
+                metrics = self.processor.metrics
+                metrics.command_started(command.operator)
+                try:
+                    CONCURRENT_READS[command.operator](connection, command, captured)
+                finally:
+                    metrics.command_finished()
+            finally:
+                connection.exec_driver_sql("ROLLBACK")
+
+    def complete(self, sequence, captured, future, error=None):
+        """Doběhnutý příkaz: volající dostane výsledek hned, výstup se do souboru zapíše až v pořadí přijetí"""
+        if not future.done():
+            if error is None:
+                future.set_result(captured.text())
+            else:
+                future.set_exception(error)
+
+        self.outputs[sequence] = captured
+        while self.next_output in self.outputs:
+            self.outputs.pop(self.next_output).replay(self.output)
+            self.output.command_done()
+            self.next_output = self.next_output + 1
+
+    def dump_metrics(self):
+        with open(self.metrics_file, 'w') as file:
+            self.processor.metrics.dump(file)
+
+    def in_writer(self, function, *args):
+        return self.loop.run_in_executor(self.writer, function, *args)
+
+
+def future_set_result(future):
+    if not future.done():
+        future.set_result(None)
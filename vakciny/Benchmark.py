@@ -0,0 +1,191 @@
+# Benchmark databaseOperator nad syntetickou zátěží z Workload.py
+#
+# Pro každou velikost (SCALES) se vygeneruje zátěž, naparsuje se a projde celá přes CommandProcessor (stejně jako
+# v korutině databaseOperator). Příkazy se provádějí se simulovaným časem, který se po každém ENDDAY posune o den,
+# takže se termíny z ENDDAY druhý den opravdu přesunou do VaccinationLog a FIND*/GIVESTATISTICS pracují s historií.
+# Měří se doba každého příkazu (souhrnně podle typu příkazu) a doba vybraných vnitřních funkcí (ENDDAY po částech,
+# find_and_set_date, dotazy FIND*/PRINT*). Výsledek se zapíše jako JSON, aby šlo výsledky porovnávat mezi verzemi.
+#
+# Použití: python Benchmark.py [--scales 1k 100k] [--output vysledky.json] [--database sqlite:///bench.db]
+
+# Imports
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import sqlalchemy
+
+import Vaccination
+import Workload
+
+# velikost -> (tučňáci, centra, okrsky, dny ENDDAY)
+SCALES = {
+    "1k": (1000, 20, 5, 5),
+    "100k": (100000, 400, 40, 10),
+    "1M": (1000000, 2000, 100, 10),
+}
+
+# Čas, kterým začíná simulovaný den (datum je den spuštění benchmarku)
+BENCHMARK_DAY_START = datetime.time(10, 0)
+
+# Vnitřní funkce Vaccination, jejichž doba se měří zvlášť. Měří se jen volání přes globální jméno modulu,
+# plánování v ENDDAY proto musí běžet v tomto procesu (schedulingWorkers=None).
+TIMED_FUNCTIONS = ("endday_rollover", "reprioritize", "endday_candidates", "endday_schedule", "endday_apply",
+                   "find_and_set_date", "find_query", "printvalidtimes_query", "printregistered_rows")
+
+
+def run_benchmark(scale, penguins, centers, districts, days, databaseUrl="sqlite:///:memory:", seed=0,
+                  queriesPerDay=50, batchSize=1, bulkRegistrations=False, vaccinationsLimit=2, oldAge=65):
+    """Provede jednu velikost zátěže a vrátí slovník s výsledky"""
+    first_day = datetime.date.today()
+    started = time.perf_counter()
+    lines = list(Workload.generate_workload(penguins, centers, districts, days, seed,
+                                            vaccinationsLimit=vaccinationsLimit, queriesPerDay=queriesPerDay,
+                                            today=first_day))
+    generate_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    commands = Vaccination.parse_commands(lines)
+    if bulkRegistrations:
+        commands = Vaccination.batch_registrations(commands)
+    parse_seconds = time.perf_counter() - started
+
+    command_times = {}
+    function_times = {}
+    originals = benchmark_wrap_functions(function_times)
+
+    output_file = tempfile.NamedTemporaryFile(prefix="benchmark", suffix=".txt", delete=False)
+    output_file.close()
+    output = Vaccination.OutputWriter(output_file.name, flushEvery=0)
+    processor = None
+    try:
+        processor = Vaccination.CommandProcessor(vaccinationsLimit, oldAge, output, batchSize,
+                                                 databaseUrl=databaseUrl)
+        now = datetime.datetime.combine(first_day, BENCHMARK_DAY_START)
+
+        started = time.perf_counter()
+        for command in commands:
+            command_started = time.perf_counter()
+            processor.execute(command, now=now)
+            output.command_done()
+            command_times.setdefault(command.operator, []).append(time.perf_counter() - command_started)
+            if command.operator == "ENDDAY":
+                now = now + datetime.timedelta(days=1)
+        processor.commit()
+        run_seconds = time.perf_counter() - started
+        statistics = Vaccination.CapturedOutput()
+        Vaccination.givestatistics(processor.stats, statistics)
+    finally:
+        for name, function in originals.items():
+            setattr(Vaccination, name, function)
+        output.close()
+        if processor is not None:
+            processor.close()
+        os.remove(output_file.name)
+
+    return {
+        "scale": scale,
+        "penguins": penguins,
+        "centers": centers,
+        "districts": districts,
+        "days": days,
+        "first_day": first_day.isoformat(),
+        "batch_size": batchSize,
+        "bulk_registrations": bulkRegistrations,
+        "commands": len(commands),
+        "generate_seconds": generate_seconds,
+        "parse_seconds": parse_seconds,
+        "run_seconds": run_seconds,
+        "commands_per_second": len(commands) / run_seconds if run_seconds > 0 else None,
+        "operators": {operator: benchmark_summary(times) for operator, times in sorted(command_times.items())},
+        "functions": {name: benchmark_summary(times) for name, times in sorted(function_times.items())},
+        "statistics": statistics.text().splitlines(),
+    }
+
+
+def benchmark_wrap_functions(function_times):
+    """Nahradí funkce z TIMED_FUNCTIONS obalem, který měří dobu každého volání. Vrátí původní funkce."""
+    originals = {}
+    for name in TIMED_FUNCTIONS:
+        function = getattr(Vaccination, name)
+        originals[name] = function
+        setattr(Vaccination, name, benchmark_timed(function, function_times.setdefault(name, [])))
+    return originals
+
+
+def benchmark_timed(function, times):
+    def timed(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            times.append(time.perf_counter() - started)
+    return timed
+
+
+def benchmark_summary(times):
+    """Souhrn naměřených dob v sekundách"""
+    if not times:
+        return {"count": 0}
+
+    ordered = sorted(times)
+    return {
+        "count": len(ordered),
+        "total": sum(ordered),
+        "mean": sum(ordered) / len(ordered),
+        "min": ordered[0],
+        "p50": benchmark_percentile(ordered, 0.5),
+        "p95": benchmark_percentile(ordered, 0.95),
+        "p99": benchmark_percentile(ordered, 0.99),
+        "max": ordered[-1],
+    }
+
+
+def benchmark_percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def benchmark_environment():
+    return {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "sqlalchemy": sqlalchemy.__version__,
+        "platform": platform.platform(),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark příkazů databaseOperator")
+    parser.add_argument("--scales", nargs="+", default=["1k"], choices=sorted(SCALES),
+                        help="velikosti zátěže (výchozí 1k)")
+    parser.add_argument("--output", default="-", help="soubor pro výsledky v JSON (výchozí standardní výstup)")
+    parser.add_argument("--database", default="sqlite:///:memory:",
+                        help="URL databáze; souborová databáze se pro každou velikost musí začínat prázdná")
+    parser.add_argument("--days", type=int, default=None, help="počet dní ENDDAY (výchozí podle velikosti)")
+    parser.add_argument("--queries", type=int, default=50, help="počet dotazů po každém ENDDAY")
+    parser.add_argument("--batch-size", type=int, default=1, help="po kolika příkazech se potvrdí transakce")
+    parser.add_argument("--bulk-registrations", action="store_true",
+                        help="posílat po sobě jdoucí REGISTERPENGUIN hromadně (batch_registrations)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    results = {"environment": benchmark_environment(), "results": []}
+    for scale in args.scales:
+        penguins, centers, districts, days = SCALES[scale]
+        if args.days is not None:
+            days = args.days
+        print("benchmark %s ..." % scale, file=sys.stderr)
+        results["results"].append(run_benchmark(scale, penguins, centers, districts, days, args.database, args.seed,
+                                                args.queries, args.batch_size, args.bulk_registrations))
+
+    if args.output == "-":
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
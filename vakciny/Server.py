@@ -0,0 +1,140 @@
+# Server, který přijímá příkazy přes Unix socket nebo TCP na localhostu
+#
+# Poznámka k řešení: Všechna spojení sdílí jeden AsyncOperator, tedy jednu databázi a jeden výstupní soubor.
+# Protokol je po řádcích: klient posílá příkazy ve stejném tvaru jako databaseOperator (jeden na řádek), server na
+# každý příkaz odpoví ve stejném pořadí, v jakém příkazy přišly:
+#   OK <počet řádků>      a za ním řádky výstupu příkazu (PRINT*/FIND*/GIVESTATISTICS), ostatní příkazy mají 0 řádků
+#   ERR <popis chyby>     pokud příkaz selhal (zahodí se jen jeho změny, dřívější zápisy s OK zůstanou)
+# Prázdné řádky se ignorují a nedostanou odpověď, neznámé příkazy dostanou "OK 0".
+#
+# Klient nemusí na odpověď čekat a může posílat další příkazy (pipelining). Příkazy se zařazují hned, jak přijdou,
+# takže se zapisovač nezastaví kvůli síti; pokud klient odpovědi nečte, server po MAX_PIPELINED nevyřízených
+# příkazech přestane číst další.
+#
+# Použití: python Server.py --unix /tmp/vakciny.sock [--database sqlite:///vakciny.db] [--output vystup.txt]
+#          python Server.py --port 7000
+
+# Imports
+import argparse
+import asyncio
+import logging
+import signal
+
+import AsyncOperator
+
+logger = logging.getLogger(__name__)
+
+# nejvýše tolik příkazů jednoho spojení může čekat na odeslání odpovědi
+MAX_PIPELINED = 10000
+# nejdelší přijatý řádek příkazu (REGISTERPENGUIN se všemi dny a centry je výrazně kratší)
+MAX_LINE_LENGTH = 1 << 20
+
+
+async def serve(operator, unixPath=None, host="127.0.0.1", port=None):
+    """Spustí server nad běžícím AsyncOperator a vrátí asyncio.Server"""
+    def connected(reader, writer):
+        return server_connection(operator, reader, writer)
+
+    if unixPath is not None:
+        return await asyncio.start_unix_server(connected, unixPath, limit=MAX_LINE_LENGTH)
+    return await asyncio.start_server(connected, host, port, limit=MAX_LINE_LENGTH)
+
+
+async def server_connection(operator, reader, writer):
+    """Jedno spojení: čte příkazy a zařazuje je, odpovědi posílá samostatná úloha v pořadí příkazů"""
+    replies = asyncio.Queue(MAX_PIPELINED)
+    sender = asyncio.get_running_loop().create_task(server_send_replies(replies, writer))
+    try:
+        while not sender.done():
+            line = await reader.readline()
+            if not line:
+                break
+            line = line.decode().rstrip("\r\n")
+            if line == "" or line.isspace():
+                continue
+            await replies.put(server_enqueue(operator, line))
+    except (ConnectionError, ValueError) as exception:     # ValueError: příliš dlouhý řádek
+        logger.warning("spojení ukončeno: %r", exception)
+    finally:
+        await replies.put(None)
+        await sender
+        writer.close()
+
+
+def server_enqueue(operator, line):
+    """Zařadí řádek do operátoru; chyba při parsování se klientovi vrátí stejně jako chyba příkazu"""
+    try:
+        return operator.enqueue(line)
+    except Exception as exception:
+        future = asyncio.get_running_loop().create_future()
+        future.set_exception(exception)
+        return future
+
+
+async def server_send_replies(replies, writer):
+    """Posílá odpovědi na příkazy v pořadí, v jakém přišly"""
+    broken = False
+    while True:
+        future = await replies.get()
+        if future is None:
+            return
+        try:
+            text = await future
+            reply = "OK %d\n%s" % (text.count("\n"), text)
+        except Exception as exception:
+            reply = "ERR %s\n" % server_error_text(exception)
+        if broken:
+            continue    # klient už odpovědi nečte, příkazy ale doběhnou
+
+        writer.write(reply.encode())
+        try:
+            await writer.drain()
+        except ConnectionError:
+            broken = True
+
+
+def server_error_text(exception):
+    return ("%s: %s" % (type(exception).__name__, exception)).replace("\n", " ")
+
+
+async def server_main(args):
+    operator = AsyncOperator.AsyncOperator(args.vaccinations_limit, args.old_age, args.output,
+                                           readWorkers=args.read_workers, batchSize=args.batch_size,
+                                           databaseUrl=args.database, metricsFile=args.metrics,
+                                           snapshotFile=args.snapshot, journalFile=args.journal,
+                                           checkpointFile=args.checkpoint, checkpointEvery=args.checkpoint_every)
+    async with operator:
+        server = await serve(operator, args.unix, args.host, args.port)
+        stopped = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signal_number, stopped.set)
+
+        logger.info("server naslouchá na %s", ", ".join(str(socket.getsockname()) for socket in server.sockets))
+        await stopped.wait()
+        server.close()
+        await server.wait_closed()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Server pro příkazy vakcinačního systému")
+    address = parser.add_mutually_exclusive_group(required=True)
+    address.add_argument("--unix", help="cesta k Unix socketu")
+    address.add_argument("--port", type=int, help="TCP port")
+    parser.add_argument("--host", default="127.0.0.1", help="adresa pro TCP (výchozí jen localhost)")
+    parser.add_argument("--database", default="sqlite:///:memory:", help="URL databáze")
+    parser.add_argument("--snapshot", default=None, help="snímek z příkazu SNAPSHOT, který se načte při startu")
+    parser.add_argument("--journal", default=None, help="deník příkazů pro obnovu po pádu")
+    parser.add_argument("--checkpoint", default=None, help="soubor pro checkpointy deníku")
+    parser.add_argument("--checkpoint-every", type=int, default=None,
+                        help="po kolika zapsaných příkazech se udělá checkpoint")
+    parser.add_argument("--output", default="output.txt", help="výstupní soubor příkazů (výchozí output.txt)")
+    parser.add_argument("--vaccinations-limit", type=int, default=2)
+    parser.add_argument("--old-age", type=int, default=65)
+    parser.add_argument("--batch-size", type=int, default=1, help="po kolika příkazech se potvrdí transakce")
+    parser.add_argument("--read-workers", type=int, default=4, help="počet vláken pro souběžná čtení")
+    parser.add_argument("--metrics", default=None, help="soubor pro metriky příkazů při ukončení")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(server_main(args))
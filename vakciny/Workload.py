@@ -0,0 +1,170 @@
+# Generátor syntetické zátěže pro databaseOperator
+#
+# Vytváří proud příkazů ve stejném tvaru, v jakém je dostává databaseOperator: nejdřív centra, tučňáky a jejich
+# registrace, pak několik změn registrací a nakonec pro každý den ENDDAY s dotazy FIND*/PRINT*.
+# Generátor je deterministický (pro stejné parametry a seed vrací stejné příkazy) a sám databázi nepotřebuje.
+#
+# Použití: python Workload.py PENGUINS CENTERS DISTRICTS DAYS [--seed S] > prikazy.txt
+
+# Imports
+import argparse
+import datetime
+import random
+import sys
+
+WEEK_DAYS = 7
+
+
+def generate_workload(penguins, centers, districts, days, seed=0, vaccinationsLimit=2, queriesPerDay=50,
+                      changes=None, today=None):
+    """Vrátí iterátor příkazů (řádků bez konce řádku) pro penguins tučňáků, centers center v districts okrscích
+    a days dní ENDDAY.
+
+    :param queriesPerDay: kolik dotazů FIND*/PRINT* se pošle po každém ENDDAY
+    :param changes: kolik příkazů CHANGEREGISTRATION* se pošle před prvním ENDDAY (None = desetina tučňáků)
+    :param today: datum, podle kterého se volí data v dotazech FIND* (None = dnešek)
+    """
+    rng = random.Random(seed)
+    if today is None:
+        today = datetime.date.today()
+    if changes is None:
+        changes = penguins // 10
+
+    centers_by_district = {}
+    for center_id in range(centers):
+        centers_by_district.setdefault(center_id % districts, []).append(center_id)
+
+    # okrsek a počet dávek každého tučňáka; registrují se jen ti, kteří ještě nemají všechny dávky
+    penguin_data = [(rng.randrange(districts), rng.randint(0, vaccinationsLimit) if rng.random() < 0.05
+                     else rng.randint(0, vaccinationsLimit - 1)) for _ in range(penguins)]
+    registrations = {}      # tučňák -> množina jeho ValidCenters
+
+    yield from workload_centers(rng, centers, districts)
+    yield from workload_penguins(rng, penguin_data, today)
+    yield from workload_registrations(rng, penguin_data, vaccinationsLimit, centers_by_district, registrations)
+    yield from workload_changes(rng, changes, centers, registrations)
+    for day in range(days):
+        yield from workload_day(rng, day, penguins, centers, districts, queriesPerDay, today)
+
+
+def workload_centers(rng, centers, districts):
+    """CREATECENTER s otevírací dobou mezi 6:00 a 20:00"""
+    for center_id in range(centers):
+        opens = rng.randint(6, 10)
+        closes = rng.randint(opens + 4, 20)
+        yield "CREATECENTER %d %d %d %d %d %d %d" % (center_id, center_id % districts, opens, rng.choice((0, 30)),
+                                                       closes, rng.choice((0, 30)), rng.randint(5, 40))
+
+
+def workload_penguins(rng, penguin_data, today):
+    """CREATEPENGUIN s věkem do 90 let"""
+    for penguin_id, (district, vaccine_number) in enumerate(penguin_data):
+        birthday = today - datetime.timedelta(days=rng.randint(365, 90 * 365))
+        yield "CREATEPENGUIN %d Penguin%d Tux%d %d-%d-%d %d %d %d" % (
+            penguin_id, penguin_id, penguin_id % 1000, birthday.year, birthday.month, birthday.day,
+            district, vaccine_number, rng.random() < 0.03)
+
+
+def workload_registrations(rng, penguin_data, vaccinationsLimit, centers_by_district, registrations):
+    """REGISTERPENGUIN s jedním až třemi centry z okrsku tučňáka a náhodnými dny a časy"""
+    for penguin_id, (district, vaccine_number) in enumerate(penguin_data):
+        if vaccine_number >= vaccinationsLimit:
+            continue
+        district_centers = centers_by_district.get(district) or centers_by_district[0]
+        chosen = rng.sample(district_centers, min(len(district_centers), rng.randint(1, 3)))
+        registrations[penguin_id] = set(chosen)
+        yield "REGISTERPENGUIN %d CENTERS %s %s" % (penguin_id, " ".join(map(str, chosen)), workload_times(rng))
+
+
+def workload_times(rng):
+    """Klauzule časů pro REGISTERPENGUIN: ALWAYS, nebo několik různých dní, celých nebo s intervalem"""
+    if rng.random() < 0.2:
+        return "ALWAYS"
+
+    clauses = []
+    for day in rng.sample(range(WEEK_DAYS), rng.randint(1, 4)):
+        if rng.random() < 0.4:
+            clauses.append("DAY %d" % day)
+        else:
+            start = rng.randint(6, 14)
+            clauses.append("DAY %d %d 0 %d %d" % (day, start, rng.randint(start + 1, 20), rng.choice((0, 30))))
+    return " ".join(clauses)
+
+
+def workload_changes(rng, changes, centers, registrations):
+    """CHANGEREGISTRATIONCENTERS a CHANGEREGISTRATIONTIMES. Centra se přidávají jen ta, která tučňák ještě nemá,
+    a odebírají jen ta, která má, aby příkazy byly platné."""
+    registered = sorted(registrations)
+    if not registered:
+        return
+
+    for _ in range(changes):
+        penguin_id = rng.choice(registered)
+        if rng.random() < 0.5:
+            valid_centers = registrations[penguin_id]
+            added = rng.randrange(centers)
+            parts = []
+            if added not in valid_centers:
+                valid_centers.add(added)
+                parts.append(str(added))
+            if len(valid_centers) > 1:
+                removed = rng.choice(sorted(valid_centers))
+                valid_centers.discard(removed)
+                parts.append("-%d" % removed)
+            if parts:
+                yield "CHANGEREGISTRATIONCENTERS %d %s" % (penguin_id, " ".join(parts))
+        else:
+            day = rng.randrange(WEEK_DAYS)
+            clause = rng.choice(("DAY %d NOT" % day, "DAY %d" % day, "DAY %d 8 0 16 30" % day))
+            yield "CHANGEREGISTRATIONTIMES %d %s" % (penguin_id, clause)
+
+
+def workload_day(rng, day, penguins, centers, districts, queriesPerDay, today):
+    """Jeden den: ENDDAY s novými vakcínami pro část center a po něm dotazy"""
+    delivered = rng.sample(range(centers), max(1, centers // 4))
+    yield "ENDDAY " + " ".join("%d %d" % (center_id, rng.randint(1, 30)) for center_id in sorted(delivered))
+
+    dates = [today + datetime.timedelta(days=offset) for offset in range(day + 2)]
+    for _ in range(queriesPerDay):
+        yield workload_query(rng, penguins, centers, districts, dates)
+
+
+def workload_query(rng, penguins, centers, districts, dates):
+    """Náhodný dotaz FIND*/PRINT*/GIVESTATISTICS"""
+    kind = rng.random()
+    penguin_id = rng.randrange(max(penguins, 1))
+    center_id = rng.randrange(max(centers, 1))
+    date = rng.choice(dates).strftime("%Y %m %d")
+    if kind < 0.15:
+        return "PRINTREGISTERED %d" % rng.randint(1, 50)
+    if kind < 0.25:
+        return "PRINTREGISTERED %d AFTER %d" % (rng.randint(1, 50), rng.randrange(max(penguins, 1)))
+    if kind < 0.35:
+        return "PRINTFREECENTERS %d" % rng.randrange(districts)
+    if kind < 0.55:
+        day = rng.randrange(WEEK_DAYS)
+        return rng.choice(("PRINTVALIDTIMES ID %d" % penguin_id, "PRINTVALIDTIMES ID %d DAY %d" % (penguin_id, day),
+                           "PRINTVALIDTIMES DAY %d 9 0 10 0" % day))
+    if kind < 0.75:
+        return rng.choice(("FINDAPPOINTMENTS ID %d" % penguin_id, "FINDAPPOINTMENTS CENTER %d" % center_id,
+                           "FINDAPPOINTMENTS CENTERDATE %d %s" % (center_id, date)))
+    if kind < 0.97:
+        return rng.choice(("FINDLOGGEDVACCINATIONS ID %d" % penguin_id,
+                           "FINDLOGGEDVACCINATIONS CENTERDATE %d %s" % (center_id, date),
+                           "FINDLOGGEDVACCINATIONS DATE %s LEVEL 1" % date))
+    return "GIVESTATISTICS"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Vypíše syntetický proud příkazů pro databaseOperator")
+    parser.add_argument("penguins", type=int)
+    parser.add_argument("centers", type=int)
+    parser.add_argument("districts", type=int)
+    parser.add_argument("days", type=int)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--queries", type=int, default=50, help="počet dotazů po každém ENDDAY")
+    args = parser.parse_args()
+
+    sys.stdout.writelines(command + "\n" for command in
+                          generate_workload(args.penguins, args.centers, args.districts, args.days, args.seed,
+                                            queriesPerDay=args.queries))